@@ -0,0 +1,369 @@
+package main
+
+import (
+	"context"
+	"database/sql"
+	"database/sql/driver"
+	"errors"
+	"fmt"
+	"io"
+	"os"
+	"path/filepath"
+	"reflect"
+	"strings"
+	"testing"
+)
+
+func TestLoadDiffStateMissingFile(t *testing.T) {
+	path := filepath.Join(t.TempDir(), "state.json")
+	state := loadDiffState(path, stateFingerprint("src", "dst"))
+	if len(state.Tables) != 0 {
+		t.Fatalf("期望空状态，实际 %v", state.Tables)
+	}
+}
+
+func TestDiffStateSaveLoad(t *testing.T) {
+	path := filepath.Join(t.TempDir(), "state.json")
+	fp := stateFingerprint("src", "dst")
+
+	state := loadDiffState(path, fp)
+	want := tableState{SrcUpdateTime: "2026-01-01 00:00:00", DstUpdateTime: "2026-01-01 00:00:01", SrcRows: 10, DstRows: 10}
+	state.record("db1", "t1", want)
+	if err := state.save(path); err != nil {
+		t.Fatalf("save: %v", err)
+	}
+	if _, err := os.Stat(path + ".tmp"); !os.IsNotExist(err) {
+		t.Fatalf("临时文件未被 rename: %v", err)
+	}
+
+	loaded := loadDiffState(path, fp)
+	got, ok := loaded.lookup("db1", "t1", want.SrcUpdateTime, want.DstUpdateTime)
+	if !ok || got != want {
+		t.Fatalf("lookup = %v, %v，期望 %v, true", got, ok, want)
+	}
+}
+
+func TestLoadDiffStateFingerprintMismatch(t *testing.T) {
+	path := filepath.Join(t.TempDir(), "state.json")
+
+	state := loadDiffState(path, stateFingerprint("src", "dst"))
+	state.record("db1", "t1", tableState{SrcUpdateTime: "a", DstUpdateTime: "b", SrcRows: 1, DstRows: 1})
+	if err := state.save(path); err != nil {
+		t.Fatalf("save: %v", err)
+	}
+
+	other := loadDiffState(path, stateFingerprint("src", "other_dst"))
+	if len(other.Tables) != 0 {
+		t.Fatalf("fingerprint 不匹配时应忽略旧记录，实际 %v", other.Tables)
+	}
+	if _, ok := other.lookup("db1", "t1", "a", "b"); ok {
+		t.Fatal("fingerprint 不匹配时不应命中")
+	}
+}
+
+func TestLoadDiffStateCorruptFile(t *testing.T) {
+	path := filepath.Join(t.TempDir(), "state.json")
+	if err := os.WriteFile(path, []byte("{not json"), 0644); err != nil {
+		t.Fatal(err)
+	}
+	state := loadDiffState(path, stateFingerprint("src", "dst"))
+	if len(state.Tables) != 0 {
+		t.Fatalf("无法解析时应返回空状态，实际 %v", state.Tables)
+	}
+}
+
+func TestDiffStateLookup(t *testing.T) {
+	state := &diffState{Tables: map[string]tableState{
+		"db1.t1": {SrcUpdateTime: "a", DstUpdateTime: "b", SrcRows: 1, DstRows: 1},
+	}}
+	cases := []struct {
+		name     string
+		src, dst string
+		want     bool
+	}{
+		{"两端一致", "a", "b", true},
+		{"源端变化", "a2", "b", false},
+		{"目标端变化", "a", "b2", false},
+		{"源端为 NULL", "", "b", false},
+		{"目标端为 NULL", "a", "", false},
+	}
+	for _, c := range cases {
+		if _, ok := state.lookup("db1", "t1", c.src, c.dst); ok != c.want {
+			t.Errorf("%s: lookup = %v，期望 %v", c.name, ok, c.want)
+		}
+	}
+	if _, ok := state.lookup("db1", "t2", "a", "b"); ok {
+		t.Error("未记录的表不应命中")
+	}
+}
+
+func TestDiffStateUpdate(t *testing.T) {
+	state := &diffState{Tables: map[string]tableState{
+		"db1.stale": {SrcUpdateTime: "x", DstUpdateTime: "y", SrcRows: 1, DstRows: 1},
+	}}
+	tables := []string{"ok", "mismatch", "null_time", "failed", "stale"}
+	srcRet := []int64{5, 5, 5, missingCount, 3}
+	dstRet := []int64{5, 9, 5, 5, 4}
+	srcTimes := map[string]string{"ok": "s1", "mismatch": "s2", "failed": "s4", "stale": "s5"}
+	dstTimes := map[string]string{"ok": "d1", "mismatch": "d2", "null_time": "d3", "failed": "d4", "stale": "d5"}
+
+	state.update("db1", tables, srcRet, dstRet, srcTimes, dstTimes, 0)
+
+	want := map[string]tableState{
+		"db1.ok": {SrcUpdateTime: "s1", DstUpdateTime: "d1", SrcRows: 5, DstRows: 5},
+	}
+	if !reflect.DeepEqual(state.Tables, want) {
+		t.Fatalf("update 后 Tables = %v，期望 %v", state.Tables, want)
+	}
+}
+
+func TestReuseStateCounts(t *testing.T) {
+	newState := func() *diffState {
+		return &diffState{Tables: map[string]tableState{
+			"db1.a": {SrcUpdateTime: "sa", DstUpdateTime: "da", SrcRows: 10, DstRows: 10},
+			"db1.b": {SrcUpdateTime: "sb", DstUpdateTime: "db", SrcRows: 20, DstRows: 20},
+			"db1.c": {SrcUpdateTime: "sc", DstUpdateTime: "dc", SrcRows: 30, DstRows: 30},
+		}}
+	}
+	tables := []string{"a", "b", "c", "d"}
+	// b 的源端已变化，c 的目标端 UPDATE_TIME 为 NULL，d 从未记录
+	srcTimes := map[string]string{"a": "sa", "b": "sb2", "c": "sc", "d": "sd"}
+	dstTimes := map[string]string{"a": "da", "b": "db", "d": "dd"}
+
+	d := &DBDataDiff{state: newState()}
+	srcRet, dstRet, countTables, countIdx := d.reuseStateCounts("db1", tables, srcTimes, dstTimes)
+	if !reflect.DeepEqual(countTables, []string{"b", "c", "d"}) || !reflect.DeepEqual(countIdx, []int{1, 2, 3}) {
+		t.Fatalf("countTables = %v, countIdx = %v", countTables, countIdx)
+	}
+	if srcRet[0] != 10 || dstRet[0] != 10 {
+		t.Fatalf("未变化的表应沿用上次行数，实际 src=%d dst=%d", srcRet[0], dstRet[0])
+	}
+
+	d = &DBDataDiff{state: newState(), fullCount: true}
+	srcRet, dstRet, countTables, countIdx = d.reuseStateCounts("db1", tables, srcTimes, dstTimes)
+	if srcRet != nil || dstRet != nil || countIdx != nil || !reflect.DeepEqual(countTables, tables) {
+		t.Fatalf("--full 时应全部 COUNT，实际 countTables = %v, countIdx = %v", countTables, countIdx)
+	}
+
+	d = &DBDataDiff{}
+	_, _, countTables, countIdx = d.reuseStateCounts("db1", tables, nil, nil)
+	if countIdx != nil || !reflect.DeepEqual(countTables, tables) {
+		t.Fatalf("未启用 state_file 时应全部 COUNT，实际 countTables = %v", countTables)
+	}
+}
+
+// fakeCountDriver 按表名返回固定行数，表名为 nope 的表报错，用于在没有数据库的情况下测试 COUNT 路径。
+type fakeCountDriver struct{}
+
+type fakeCountConn struct{}
+
+type fakeCountRows struct {
+	columns []string
+	values  [][]driver.Value
+}
+
+var fakeTableCounts = map[string]int64{"a": 1, "b": 2, "c": 3, "d": 4}
+
+func init() {
+	sql.Register("fakecount", fakeCountDriver{})
+}
+
+func (fakeCountDriver) Open(string) (driver.Conn, error) { return fakeCountConn{}, nil }
+
+func (fakeCountConn) Prepare(string) (driver.Stmt, error) { return nil, errors.New("not supported") }
+func (fakeCountConn) Close() error                        { return nil }
+func (fakeCountConn) Begin() (driver.Tx, error)           { return nil, errors.New("not supported") }
+
+func (fakeCountConn) QueryContext(_ context.Context, query string, _ []driver.NamedValue) (driver.Rows, error) {
+	parts := strings.Split(query, " UNION ALL ")
+	rows := &fakeCountRows{columns: []string{"idx", "cnt"}}
+	if len(parts) == 1 {
+		rows.columns = []string{"cnt"}
+	}
+	for i, part := range parts {
+		table := strings.Trim(part[strings.LastIndex(part, ".")+1:], "`")
+		cnt, ok := fakeTableCounts[table]
+		if !ok {
+			return nil, fmt.Errorf("Table 'db1.%s' doesn't exist", table)
+		}
+		if len(parts) == 1 {
+			rows.values = append(rows.values, []driver.Value{cnt})
+		} else {
+			rows.values = append(rows.values, []driver.Value{int64(i), cnt})
+		}
+	}
+	return rows, nil
+}
+
+func (r *fakeCountRows) Columns() []string { return r.columns }
+func (r *fakeCountRows) Close() error      { return nil }
+
+func (r *fakeCountRows) Next(dest []driver.Value) error {
+	if len(r.values) == 0 {
+		return io.EOF
+	}
+	copy(dest, r.values[0])
+	r.values = r.values[1:]
+	return nil
+}
+
+func TestCountTableRowsConcurrentBatchFallback(t *testing.T) {
+	db, err := sql.Open("fakecount", "")
+	if err != nil {
+		t.Fatal(err)
+	}
+	defer db.Close()
+
+	for _, batchSize := range []int{1, 3, 5} {
+		pool := newSnapshotConnPool(db, nil, nil, 4)
+		d := &DBDataDiff{countBatchSize: batchSize}
+		result, errs := d.countTableRowsConcurrent(pool, "db1", []string{"a", "nope", "c", "d"}, 2)
+		pool.close()
+
+		want := []int64{1, missingCount, 3, 4}
+		if !reflect.DeepEqual(result, want) {
+			t.Errorf("count_batch_size=%d: result = %v，期望 %v", batchSize, result, want)
+		}
+		if len(errs) != 1 || !strings.Contains(errs[0].Error(), "表 nope 统计失败") {
+			t.Errorf("count_batch_size=%d: 只应记录 nope 的错误，实际 %v", batchSize, errs)
+		}
+	}
+}
+
+func TestSetIgnoreTables(t *testing.T) {
+	d := &DBDataDiff{}
+	d.setIgnoreTables([]string{"Orders", "tmp_log"})
+	clause, args := d.ignoreTablesClause()
+	if clause != " AND CAST(table_name AS BINARY) NOT IN (?,?)" {
+		t.Fatalf("clause = %q", clause)
+	}
+	if !reflect.DeepEqual(args, []interface{}{"Orders", "tmp_log"}) {
+		t.Fatalf("args = %v", args)
+	}
+
+	d.setIgnoreTables(nil)
+	if clause, args := d.ignoreTablesClause(); clause != "" || args != nil {
+		t.Fatalf("清空后 clause = %q, args = %v", clause, args)
+	}
+
+	// tables 模式同样区分大小写
+	got := d.removeIgnoredTables([]string{"Orders", "orders"}, map[string]struct{}{"Orders": {}})
+	if !reflect.DeepEqual(got, []string{"orders"}) {
+		t.Fatalf("removeIgnoredTables = %v", got)
+	}
+}
+
+// fakeSessionDriver 的连接像真实 driver 一样在复用时保留 session 变量，只支持本工具设置/读取 tidb_snapshot 的语句。
+type fakeSessionDriver struct{}
+
+type fakeSessionConn struct {
+	snapshot string
+}
+
+func init() {
+	sql.Register("fakesession", fakeSessionDriver{})
+}
+
+func (fakeSessionDriver) Open(string) (driver.Conn, error) { return &fakeSessionConn{}, nil }
+
+func (*fakeSessionConn) Prepare(string) (driver.Stmt, error) { return nil, errors.New("not supported") }
+func (*fakeSessionConn) Close() error                        { return nil }
+func (*fakeSessionConn) Begin() (driver.Tx, error)           { return nil, errors.New("not supported") }
+
+func (c *fakeSessionConn) ExecContext(_ context.Context, query string, args []driver.NamedValue) (driver.Result, error) {
+	switch query {
+	case "SET @@tidb_snapshot=?":
+		c.snapshot = fmt.Sprint(args[0].Value)
+	case "SET @@tidb_snapshot = ''":
+		c.snapshot = ""
+	}
+	return driver.RowsAffected(0), nil
+}
+
+func (c *fakeSessionConn) QueryContext(_ context.Context, query string, _ []driver.NamedValue) (driver.Rows, error) {
+	if query != "SELECT @@tidb_snapshot" {
+		return nil, fmt.Errorf("unexpected query: %s", query)
+	}
+	return &fakeCountRows{columns: []string{"@@tidb_snapshot"}, values: [][]driver.Value{{c.snapshot}}}, nil
+}
+
+func TestSharedDBDoesNotLeakSnapshot(t *testing.T) {
+	for _, reset := range []bool{false, true} {
+		db, err := sql.Open("fakesession", "")
+		if err != nil {
+			t.Fatal(err)
+		}
+		// 只有一个底层连接，保证目标库一侧拿到的一定是源库用过的连接
+		db.SetMaxOpenConns(1)
+
+		snapshotTS := "462979423272960000"
+		srcPool := newSnapshotConnPool(db, &snapshotTS, nil, 1)
+		dstPool := newSnapshotConnPool(db, nil, nil, 1)
+		srcPool.resetSession, dstPool.resetSession = reset, reset
+
+		srcConn, err := srcPool.acquire()
+		if err != nil {
+			t.Fatal(err)
+		}
+		// 模拟 COUNT 出错后丢弃连接：连接回到共享的 *sql.DB 空闲池
+		_ = srcConn.Close()
+		<-srcPool.sem
+
+		dstConn, err := dstPool.acquire()
+		if err != nil {
+			t.Fatal(err)
+		}
+		var got string
+		if err := dstConn.QueryRowContext(context.Background(), "SELECT @@tidb_snapshot").Scan(&got); err != nil {
+			t.Fatal(err)
+		}
+		dstPool.release(dstConn)
+		dstPool.close()
+		srcPool.close()
+		db.Close()
+
+		if reset && got != "" {
+			t.Fatalf("resetSession=true 时目标库连接仍带有 tidb_snapshot=%s", got)
+		}
+		if !reset && got != snapshotTS {
+			// 前提校验：不重置时 fake driver 确实会把快照遗留给另一侧，否则本测试没有意义
+			t.Fatalf("resetSession=false 时期望遗留 tidb_snapshot=%s，实际 %q", snapshotTS, got)
+		}
+	}
+}
+
+func TestChunkStrings(t *testing.T) {
+	items := []string{"a", "b", "c", "d", "e", "f"}
+	cases := []struct {
+		name  string
+		items []string
+		size  int
+		want  [][]string
+	}{
+		{"size 为 0 时按 1 切分", items[:3], 0, [][]string{{"a"}, {"b"}, {"c"}}},
+		{"size 为 1", items[:3], 1, [][]string{{"a"}, {"b"}, {"c"}}},
+		{"整除", items, 3, [][]string{{"a", "b", "c"}, {"d", "e", "f"}}},
+		{"有余数", items, 4, [][]string{{"a", "b", "c", "d"}, {"e", "f"}}},
+		{"size 大于长度", items[:2], 5, [][]string{{"a", "b"}}},
+		{"空输入", nil, 3, [][]string{}},
+	}
+	for _, c := range cases {
+		got := chunkStrings(c.items, c.size)
+		if !reflect.DeepEqual(got, c.want) {
+			t.Errorf("%s: chunkStrings = %v，期望 %v", c.name, got, c.want)
+		}
+		for i, chunk := range got {
+			if cap(chunk) != len(chunk) {
+				t.Errorf("%s: 第 %d 段 cap=%d, len=%d，容量未截断", c.name, i, cap(chunk), len(chunk))
+			}
+		}
+	}
+
+	// 对最后一段 append 不能改写调用方切片之后的元素
+	backing := []string{"a", "b", "c", "d", "e"}
+	chunks := chunkStrings(backing[:3], 2)
+	_ = append(chunks[len(chunks)-1], "x")
+	if backing[3] != "d" {
+		t.Fatalf("append 最后一段改写了底层数组: %v", backing)
+	}
+}